@@ -1,163 +1,154 @@
 import os
 import re
+import duckdb
 import pandas as pd
-import numpy as np
-import xmltodict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from lxml import etree
 from tqdm import tqdm
 
+_PUNCT_RE = re.compile(r'[^\w\s]')
+
 
 class PatentDataCleaner:
 
-    def __init__(self, base_path='.', start_date_str='2002-01-01', end_date_str='2023-12-31'):
+    def __init__(self, base_path='.', start_date_str='2002-01-01', end_date_str='2023-12-31', also_csv=False):
         self.uspatent_path = os.path.join(base_path, 'uspatent')
         self.other_data_path = os.path.join(base_path, 'uva_darden')
         self.output_path = os.path.join(base_path, 'results')
         os.makedirs(self.output_path, exist_ok=True)
         self.start_date = pd.to_datetime(start_date_str)
         self.end_date = pd.to_datetime(end_date_str)
+        self.also_csv = also_csv
         self.processed_data = None
 
 
     @staticmethod
-    def _extract_record(xml_dict):
-        records = []
-        assignment_data = xml_dict.get('us-patent-assignments', {}).get('patent-assignments', {}).get('patent-assignment', [])
-        if not isinstance(assignment_data, list):
-            assignment_data = [assignment_data]
-
-        for record in assignment_data:
-            record_dict = {
-                'reel-no': record.get('assignment-record', {}).get('reel-no'),
-                'frame-no': record.get('assignment-record', {}).get('frame-no'),
-                'last-update-date': record.get('assignment-record', {}).get('last-update-date', {}).get('date'),
-                'purge-indicator': record.get('assignment-record', {}).get('purge-indicator'),
-                'recorded-date': record.get('assignment-record', {}).get('recorded-date', {}).get('date'),
-                'patent-assignors': [record.get('patent-assignors', {}).get('patent-assignor')],
-                'patent-assignees': [record.get('patent-assignees', {}).get('patent-assignee')],
-                'patent-properties': [record.get('patent-properties', {}).get('patent-property')]
-            }
-            df = pd.DataFrame.from_dict(record_dict)
-            records.append(df)
-        if not records:
+    def _extract_record(file_path):
+        rows = []
+        for _, elem in etree.iterparse(file_path, tag='patent-assignment'):
+            rows.append({
+                'reel-no': elem.findtext('assignment-record/reel-no'),
+                'frame-no': elem.findtext('assignment-record/frame-no'),
+                'last-update-date': elem.findtext('assignment-record/last-update-date/date'),
+                'purge-indicator': elem.findtext('assignment-record/purge-indicator'),
+                'recorded-date': elem.findtext('assignment-record/recorded-date/date'),
+                'patent-assignors': [{'name': a.findtext('name')}
+                                     for a in elem.iterfind('patent-assignors/patent-assignor')],
+                'patent-assignees': [{'name': a.findtext('name')}
+                                     for a in elem.iterfind('patent-assignees/patent-assignee')],
+                'patent-properties': [{'document-id': [{'doc-number': d.findtext('doc-number'),
+                                                        'kind': d.findtext('kind')}
+                                                       for d in p.iterfind('document-id')]}
+                                      for p in elem.iterfind('patent-properties/patent-property')]
+            })
+            # Free the parsed subtree so memory stays flat over large files.
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        if not rows:
             return pd.DataFrame()
-        records = pd.concat(records).reset_index(drop=True)
-        return records
+        return pd.DataFrame(rows)
 
     @staticmethod
-    def _unnest_patent(records):
-        patent_data = []
-        for index, row in records.iterrows():
-            base_info = {
-                'reel_no': row['reel-no'],
-                'frame_no': row['frame-no'],
-                'last_update_date': row['last-update-date'],
-                'recorded_date': row['recorded-date'],
-                'purge_indicator': row['purge-indicator']
-            }
-            try:
-                base_info['patent_assignors'] = [d['name'] for d in row['patent-assignors']]
-            except (TypeError, KeyError):
-                base_info['patent_assignors'] = [row['patent-assignors']['name']] if isinstance(row.get('patent-assignors'), dict) else np.nan
-
-            try:
-                base_info['patent_assignees'] = [d['name'] for d in row['patent-assignees']]
-            except (TypeError, KeyError):
-                base_info['patent_assignees'] = [row['patent-assignees']['name']] if isinstance(row.get('patent-assignees'), dict) else np.nan
-
-            patent_documents = []
-            properties = row.get('patent-properties', [])
-            if not isinstance(properties, list):
-                properties = [properties]
-
-            for prop_item in properties:
-                if not prop_item: continue
-                doc_ids = prop_item.get('document-id', [])
-                if not isinstance(doc_ids, list):
-                    doc_ids = [doc_ids]
-                for doc in doc_ids:
-                    if isinstance(doc, dict):
-                        patent_documents.append({
-                            'doc_num': doc.get('doc-number'),
-                            'doc_kind': doc.get('kind')
-                        })
-
-            for doc in patent_documents:
-                full_record = base_info.copy()
-                full_record['patent_documents'] = doc
-                patent_data.append(full_record)
-
-        if not patent_data:
-            return pd.DataFrame()
-        return pd.DataFrame(patent_data)
-
-    def process_xml_files(self):
-        print("Starting XML file processing...")
-        files = [f for f in os.listdir(self.uspatent_path) if f.endswith('.xml')]
-        for file in tqdm(files, desc="Processing XMLs"):
-            file_path = os.path.join(self.uspatent_path, file)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                xml = f.read()
+    def _collect_names(parties):
+        return [d['name'] for d in parties if d['name'] is not None]
 
-            xml_dict = xmltodict.parse(xml)
-            records = self._extract_record(xml_dict)
-            if records.empty:
-                continue
-
-            patent = self._unnest_patent(records)
-            if patent.empty:
-                continue
+    @staticmethod
+    def _collect_doc_dicts(properties):
+        patent_documents = []
+        for prop_item in properties:
+            for doc in prop_item['document-id']:
+                patent_documents.append({
+                    'doc_num': doc['doc-number'],
+                    'doc_kind': doc['kind']
+                })
+        return patent_documents
 
-            patent_df = pd.DataFrame(patent)
-            patent_df['patent_doc_num'] = patent_df['patent_documents'].apply(lambda x: x.get('doc_num'))
-            patent_df['patent_doc_kind'] = patent_df['patent_documents'].apply(lambda x: x.get('doc_kind'))
-            patent_df = patent_df.loc[patent_df['patent_doc_kind'] != 'X0']
-            patent_df = patent_df.drop('patent_documents', axis=1)
-            patent_df = patent_df.loc[patent_df['patent_assignees'].notna()]
+    @staticmethod
+    def _unnest_patent(records):
+        if records.empty:
+            return pd.DataFrame()
 
-            patent_df['patent_assignors'] = patent_df['patent_assignors'].apply(lambda x: [name.lower() for name in x] if isinstance(x, list) else np.nan)
-            patent_df['patent_assignees'] = patent_df['patent_assignees'].apply(lambda x: [name.lower() for name in x] if isinstance(x, list) else np.nan)
-            patent_df = patent_df.explode('patent_assignees').dropna(subset=['patent_assignees'])
+        records = records.rename(columns={
+            'reel-no': 'reel_no', 'frame-no': 'frame_no',
+            'last-update-date': 'last_update_date', 'recorded-date': 'recorded_date',
+            'purge-indicator': 'purge_indicator'
+        })
+        records['patent_assignors'] = records.pop('patent-assignors').map(PatentDataCleaner._collect_names)
+        records['patent_assignees'] = records.pop('patent-assignees').map(PatentDataCleaner._collect_names)
+        records['patent_documents'] = records.pop('patent-properties').map(PatentDataCleaner._collect_doc_dicts)
 
-            patent_df['patent_assignees'] = patent_df['patent_assignees'].apply(lambda x: re.sub(r'\\', '', x))
-            patent_df['patent_assignees'] = patent_df['patent_assignees'].apply(lambda x: re.sub(r'\s+', ' ', x))
+        records = records.explode('patent_documents')
+        records = records.dropna(subset=['patent_documents']).reset_index(drop=True)
+        return records[['reel_no', 'frame_no', 'last_update_date', 'recorded_date', 'purge_indicator',
+                        'patent_assignors', 'patent_assignees', 'patent_documents']]
 
-            output_csv_path = os.path.join(self.uspatent_path, file[:-4] + '.csv')
-            patent_df.to_csv(output_csv_path, index=False)
+    def process_xml_files(self):
+        print("Starting XML file processing...")
+        paths = [os.path.join(self.uspatent_path, f) for f in os.listdir(self.uspatent_path) if f.endswith('.xml')]
+        process_one = partial(_process_one_xml, start_date=self.start_date, end_date=self.end_date)
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(tqdm(executor.map(process_one, paths, chunksize=4),
+                      total=len(paths), desc="Processing XMLs"))
 
     def merge_with_classification(self):
         print("Merging with patent classification data...")
-        cpc_class = pd.read_csv(os.path.join(self.uspatent_path, 'g_cpc_current.tsv'), sep='\t')
-        uspc_class = pd.read_csv(os.path.join(self.uspatent_path, 'g_uspc_at_issue.tsv'), sep='\t')
+        cpc_class = pd.read_csv(os.path.join(self.uspatent_path, 'g_cpc_current.tsv'), sep='\t',
+                                dtype={'patent_id': 'string'}, engine='pyarrow', dtype_backend='pyarrow')
+        uspc_class = pd.read_csv(os.path.join(self.uspatent_path, 'g_uspc_at_issue.tsv'), sep='\t',
+                                 dtype={'patent_id': 'string'}, engine='pyarrow', dtype_backend='pyarrow')
 
         cpc_class = cpc_class[['patent_id', 'cpc_group']].drop_duplicates(subset=['patent_id'], keep='last')
-        cpc_class['patent_id'] = cpc_class['patent_id'].astype(str)
+        cpc_class = cpc_class.set_index('patent_id')['cpc_group']
         uspc_class = uspc_class[['patent_id', 'uspc_subclass_id']].drop_duplicates(subset=['patent_id'], keep='last')
-        uspc_class['patent_id'] = uspc_class['patent_id'].astype(str)
+        uspc_class = uspc_class.set_index('patent_id')['uspc_subclass_id']
 
-        files = [f for f in os.listdir(self.uspatent_path) if f.endswith('.csv') and f.startswith('ad')]
+        files = [f for f in os.listdir(self.uspatent_path) if f.endswith('.feather') and f.startswith('ad')]
 
-        patent_with_class = []
+        frames = []
         for file in tqdm(files, desc="Merging classification"):
             file_path = os.path.join(self.uspatent_path, file)
-            patent = pd.read_csv(file_path)
-            patent['patent_doc_num'] = patent['patent_doc_num'].astype(str)
-
-            patent = patent.merge(cpc_class, how='left', left_on='patent_doc_num', right_on='patent_id').drop('patent_id', axis=1)
-            patent = patent.merge(uspc_class, how='left', left_on='patent_doc_num', right_on='patent_id').drop('patent_id', axis=1)
-            patent = patent.loc[(patent['cpc_group'].notna()) | (patent['uspc_subclass_id'].notna())]
-            patent = patent.drop_duplicates()
-            patent_with_class.append(patent)
-
-        self.processed_data = pd.concat(patent_with_class, ignore_index=True)
+            patent = pd.read_feather(file_path, dtype_backend='pyarrow')
+            # Arrow round-trips the assignor lists as numpy arrays; restore plain lists.
+            patent['patent_assignors'] = patent['patent_assignors'].map(list, na_action='ignore')
+            frames.append(patent)
+
+        patent = pd.concat(frames, ignore_index=True)
+        # Drop references as soon as they are consumed so peak memory stays near
+        # one copy of the combined frame instead of two.
+        frames.clear()
+        patent['cpc_group'] = patent['patent_doc_num'].map(cpc_class)
+        patent['uspc_subclass_id'] = patent['patent_doc_num'].map(uspc_class)
+        del cpc_class, uspc_class
+        patent = patent.loc[(patent['cpc_group'].notna()) | (patent['uspc_subclass_id'].notna())]
+        patent = patent.drop_duplicates(subset=['reel_no', 'frame_no', 'patent_doc_num', 'patent_assignees'])
+
+        self.processed_data = patent.reset_index(drop=True)
 
     def merge_with_corporate_data(self):
         print("Merging with corporate data...")
-        patent_name = pd.read_csv(os.path.join(self.other_data_path, 'GCPD_granular_data.txt'), sep=',')
-        patent_name = patent_name[['assg_name', 'gvkey']].drop_duplicates()
-        patent_name['assg_name'] = patent_name['assg_name'].str.lower().str.replace(r'[^\w\s]', ' ', regex=True)
-
-        self.processed_data['patent_assignees'] = self.processed_data['patent_assignees'].astype(str).str.replace(r'[^\w\s]', ' ', regex=True)
-        self.processed_data = self.processed_data.merge(patent_name, how='left', left_on='patent_assignees', right_on='assg_name')
+        gcpd_path = os.path.join(self.other_data_path, 'GCPD_granular_data.txt')
+
+        con = duckdb.connect()
+        con.register('patents', self.processed_data)
+        # gvkey is cast to DOUBLE so unmatched assignees can carry NaN after the left join.
+        con.execute(
+            f"CREATE TEMP TABLE gcpd AS "
+            f"SELECT DISTINCT lower(regexp_replace(assg_name, '{_PUNCT_RE.pattern}', ' ', 'g')) AS assg_name, "
+            f"gvkey::DOUBLE AS gvkey "
+            f"FROM read_csv_auto(?)", [gcpd_path])
+        merged = con.execute(
+            f"SELECT p.* REPLACE (regexp_replace(p.patent_assignees, '{_PUNCT_RE.pattern}', ' ', 'g') "
+            f"AS patent_assignees), g.assg_name, g.gvkey "
+            f"FROM patents p "
+            f"LEFT JOIN gcpd g "
+            f"ON regexp_replace(p.patent_assignees, '{_PUNCT_RE.pattern}', ' ', 'g') = g.assg_name").df()
+        con.close()
+
+        # DuckDB hands the assignor lists back as numpy arrays; restore plain lists.
+        merged['patent_assignors'] = merged['patent_assignors'].map(list, na_action='ignore')
+        self.processed_data = merged
 
         output_file = os.path.join(self.output_path, 'patent_assignment_with_class.csv')
         self.processed_data.to_csv(output_file, index=False)
@@ -165,9 +156,6 @@ class PatentDataCleaner:
     def finalize_and_aggregate(self):
         print("Finalizing and aggregating...")
         patent_corporate = self.processed_data.loc[self.processed_data['gvkey'].notna()].copy()
-        patent_corporate['recorded_date'] = pd.to_datetime(patent_corporate['recorded_date'], format='%Y%m%d')
-        patent_corporate['last_update_date'] = pd.to_datetime(patent_corporate['last_update_date'], format='%Y%m%d')
-
         patent_corporate = patent_corporate[['patent_doc_num', 'patent_doc_kind', 'patent_assignees', 'gvkey', 'recorded_date', 'last_update_date', 'cpc_group', 'uspc_subclass_id']]
         patent_corporate = patent_corporate.rename(columns={
             'patent_doc_num': 'patent_id', 'patent_doc_kind': 'patent_kind',
@@ -177,34 +165,41 @@ class PatentDataCleaner:
         })
 
         green_class_df = pd.read_csv(os.path.join(self.uspatent_path, 'OECD_ENV_Tech_Patent_Group.csv'))
-        green_class = green_class_df['cpc_group'].tolist()
-        patent_corporate['patent_is_green'] = np.where(patent_corporate['patent_cpc_group'].isin(green_class), 1, 0)
+        green_set = set(green_class_df['cpc_group'].dropna().unique())
+        patent_corporate['patent_is_green'] = patent_corporate['patent_cpc_group'].isin(green_set).astype('int8')
 
-        df = patent_corporate.loc[
-            (patent_corporate['date_recorded'] <= self.end_date) &
-            (patent_corporate['date_recorded'] >= self.start_date)
-            ].copy()
+        # The recorded-date window was already applied per file in _process_one_xml.
+        df = patent_corporate
         print(f"Total records between {self.start_date.date()} and {self.end_date.date()}: {len(df)}")
         print(f"Total green records between {self.start_date.date()} and {self.end_date.date()}: {len(df.loc[df['patent_is_green'] == 1])}")
 
         df['year_recorded'] = df['date_recorded'].dt.year
-        year_summary = pd.DataFrame()
-        year_summary['total'] = df.groupby('year_recorded')['patent_id'].nunique()
-        year_summary['green'] = df.loc[df['patent_is_green'] == 1].groupby('year_recorded')['patent_id'].nunique()
+        nunique_by_green = df.groupby(['year_recorded', 'patent_is_green'])['patent_id'].nunique().unstack(fill_value=0)
+        year_summary = pd.DataFrame({
+            'total': nunique_by_green.sum(axis=1),
+            'green': nunique_by_green.get(1, 0)
+        })
 
-        output_corporate_file = os.path.join(self.output_path, 'patent_corporate.csv')
-        df.to_csv(output_corporate_file, index=False)
+        output_corporate_file = os.path.join(self.output_path, 'patent_corporate.parquet')
+        df.to_parquet(output_corporate_file, compression='zstd', index=False)
+        if self.also_csv:
+            df.to_csv(os.path.join(self.output_path, 'patent_corporate.csv'), index=False)
         print(f"Corporate level patent data saved to {output_corporate_file}")
 
-        patent_number = df.groupby(['assignee_gvkey', 'assignee_name', 'year_recorded']).agg(
+        # Categorical keys are hashed once here; the groupby then works on integer codes.
+        for col in ['assignee_gvkey', 'assignee_name']:
+            df[col] = df[col].astype('category')
+        patent_number = df.groupby(['assignee_gvkey', 'assignee_name', 'year_recorded'], observed=True).agg(
             patent_num=('patent_id', 'size'),
             patent_green_num=('patent_is_green', 'sum')
         ).reset_index()
         patent_number = patent_number.rename(columns={'year_recorded': 'year'})
         patent_number['patent_green_total'] = patent_number['patent_green_num'] / patent_number['patent_num']
 
-        output_agg_file = os.path.join(self.output_path, 'patent_aggregate.csv')
-        patent_number.to_csv(output_agg_file, index=False)
+        output_agg_file = os.path.join(self.output_path, 'patent_aggregate.parquet')
+        patent_number.to_parquet(output_agg_file, compression='zstd', index=False)
+        if self.also_csv:
+            patent_number.to_csv(os.path.join(self.output_path, 'patent_aggregate.csv'), index=False)
         print(f"Aggregated patent data saved to {output_agg_file}")
 
     def run_pipeline(self):
@@ -214,6 +209,40 @@ class PatentDataCleaner:
         self.finalize_and_aggregate()
 
 
+# Module-level so ProcessPoolExecutor workers can pickle it.
+def _process_one_xml(file_path, start_date, end_date):
+    records = PatentDataCleaner._extract_record(file_path)
+    if records.empty:
+        return None
+
+    patent_df = PatentDataCleaner._unnest_patent(records)
+    if patent_df.empty:
+        return None
+
+    patent_df[['patent_doc_num', 'patent_doc_kind']] = pd.DataFrame(
+        patent_df.pop('patent_documents').tolist(), index=patent_df.index)
+    patent_df = patent_df.loc[patent_df['patent_doc_kind'] != 'X0']
+
+    patent_df['patent_assignors'] = patent_df['patent_assignors'].map(lambda names: [name.lower() for name in names])
+    patent_df = patent_df.explode('patent_assignees').dropna(subset=['patent_assignees'])
+
+    patent_df['patent_assignees'] = (patent_df['patent_assignees']
+                                     .str.lower()
+                                     .str.replace(r'\\', '', regex=True)
+                                     .str.replace(r'\s+', ' ', regex=True))
+
+    # Few unique dates across millions of rows, so the to_datetime cache turns this into lookups.
+    patent_df['recorded_date'] = pd.to_datetime(patent_df['recorded_date'], format='%Y%m%d', cache=True, errors='coerce')
+    patent_df['last_update_date'] = pd.to_datetime(patent_df['last_update_date'], format='%Y%m%d', cache=True, errors='coerce')
+    # Predicate pushdown: filtering here keeps out-of-range rows out of every later merge.
+    patent_df = patent_df.loc[patent_df['recorded_date'].between(start_date, end_date)]
+
+    output_feather_path = file_path[:-4] + '.feather'
+    patent_df = patent_df.reset_index(drop=True).convert_dtypes(dtype_backend='pyarrow')
+    patent_df.to_feather(output_feather_path)
+    return output_feather_path
+
+
 
 if __name__ == '__main__':
     # Usage example:
@@ -234,9 +263,11 @@ if __name__ == '__main__':
     cleaner_default.run_pipeline()
 
     # --- Example of running with a custom date range and file paths---
+    # (also_csv=True additionally writes the final outputs as CSV next to the Parquet files)
     # cleaner_custom = PatentDataCleaner(
     #     base_path='./data',
     #     start_date_str='2010-01-01',
-    #     end_date_str='2020-12-31'
+    #     end_date_str='2020-12-31',
+    #     also_csv=True
     # )
     # cleaner_custom.run_pipeline()
\ No newline at end of file